@@ -1,13 +1,19 @@
-/* DuckDB SQL $input_file is a named query parameter passed
-   by the Python code that executes this file */
-with cart_items as (
+/* DuckDB SQL run against the validated view of JSON objects created
+   from sql/validate_carts.sql by the Python code that executes this file */
+with cart_products as (
   select
-    id as cart_id,
-    userId as user_id,
-    unnest(products).id as product_id,
-    unnest(products).quantity as quantity,
-    unnest(products).price as price
-  from read_json($input_file)
+    (json ->> '$.id')::bigint as cart_id,
+    (json ->> '$.userId')::bigint as user_id,
+    unnest(json_extract(json, '$.products[*]')) as product
+  from validated
+), cart_items as (
+  select
+    cart_id,
+    user_id,
+    (product ->> '$.id')::bigint as product_id,
+    (product ->> '$.quantity')::bigint as quantity,
+    (product ->> '$.price')::double as price
+  from cart_products
 ), cart_totals as (
   select cart_id, round(sum(quantity * price), 2) as total_cart_value
   from cart_items
@@ -19,7 +25,7 @@ select
   ci.user_id,
   ci.product_id,
   ci.quantity,
-  ci.price,
-  ct.total_cart_value
+  ci.price::decimal(10, 2) as price,
+  ct.total_cart_value::decimal(10, 2) as total_cart_value
 from cart_items ci
 inner join cart_totals ct on ct.cart_id = ci.cart_id
@@ -1,10 +1,19 @@
-/* DuckDB SQL $input_file is a named query parameter passed
-   by the Python code that executes this file */
+/* DuckDB SQL run against the validated view of JSON objects created
+   from sql/validate_products.sql by the Python code that executes this file */
+with products as (
+  select
+    (json ->> '$.id')::bigint as product_id,
+    json ->> '$.title' as name,
+    json ->> '$.category' as category,
+    json ->> '$.brand' as brand,
+    (json ->> '$.price')::double as price
+  from validated
+)
 select
-  id as product_id,
-  title as name,
+  product_id,
+  name,
   category,
   brand,
-  price
-from read_json($input_file)
+  price::decimal(10, 2) as price
+from products
 where price > 50
@@ -1,12 +1,14 @@
-/* DuckDB SQL $input_file is a named query parameter passed
-   by the Python code that executes this file */
+/* DuckDB SQL run against the validated view of JSON objects created
+   from sql/validate_users.sql by the Python code that executes this file */
 select
-  id as user_id,
-  firstName as first_name,
-  lastName as last_name,
-  gender,
-  age,
-  regexp_extract(address.address, '.+\s+([a-zA-Z]+\s+Street)$', 1) as street,
-  address.city as city,
-  address.postalCode as postal_code
-from read_json($input_file)
+  (json ->> '$.id')::bigint as user_id,
+  json ->> '$.firstName' as first_name,
+  json ->> '$.lastName' as last_name,
+  json ->> '$.gender' as gender,
+  (json ->> '$.age')::bigint as age,
+  regexp_extract(
+    json ->> '$.address.address', '.+\s+([a-zA-Z]+\s+Street)$', 1
+  ) as street,
+  json ->> '$.address.city' as city,
+  json ->> '$.address.postalCode' as postal_code
+from validated
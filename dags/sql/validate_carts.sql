@@ -0,0 +1,28 @@
+/* DuckDB SQL $input_file is a named query parameter passed
+   by the Python code that executes this file. Every record is
+   kept as a JSON object and flagged with is_valid so rejected ones
+   can be reported. JSON types are checked per record since
+   read_json would infer a single type for each whole column. */
+select
+  json,
+  coalesce(
+    json_type(json, '$.id') in ('BIGINT', 'UBIGINT')
+    and json_type(json, '$.userId') in ('BIGINT', 'UBIGINT')
+    and json_type(json, '$.products') = 'ARRAY'
+    -- carts without any products are valid
+    and coalesce(
+      list_bool_and(
+        list_transform(
+          json_extract(json, '$.products[*]'),
+          p -> json_type(p, '$.id') in ('BIGINT', 'UBIGINT')
+            and json_type(p, '$.quantity') in ('BIGINT', 'UBIGINT')
+            and try_cast(p ->> '$.quantity' as bigint) > 0
+            and json_type(p, '$.price') = 'DOUBLE'
+            and try_cast(p ->> '$.price' as double) > 0
+        )
+      ),
+      true
+    ),
+    false
+  ) as is_valid
+from read_ndjson_objects($input_file)
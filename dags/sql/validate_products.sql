@@ -0,0 +1,17 @@
+/* DuckDB SQL $input_file is a named query parameter passed
+   by the Python code that executes this file. Every record is
+   kept as a JSON object and flagged with is_valid so rejected ones
+   can be reported. JSON types are checked per record since
+   read_json would infer a single type for each whole column. */
+select
+  json,
+  coalesce(
+    json_type(json, '$.id') in ('BIGINT', 'UBIGINT')
+    and json_type(json, '$.title') = 'VARCHAR'
+    and json_type(json, '$.category') = 'VARCHAR'
+    and json_type(json, '$.brand') = 'VARCHAR'
+    and json_type(json, '$.price') = 'DOUBLE'
+    and try_cast(json ->> '$.price' as double) > 0,
+    false
+  ) as is_valid
+from read_ndjson_objects($input_file)
@@ -0,0 +1,22 @@
+/* DuckDB SQL $input_file is a named query parameter passed
+   by the Python code that executes this file. Every record is
+   kept as a JSON object and flagged with is_valid so rejected ones
+   can be reported. JSON types are checked per record since
+   read_json would infer a single type for each whole column. */
+select
+  json,
+  coalesce(
+    json_type(json, '$.id') in ('BIGINT', 'UBIGINT')
+    and json_type(json, '$.firstName') = 'VARCHAR'
+    and json_type(json, '$.lastName') = 'VARCHAR'
+    and json_type(json, '$.gender') = 'VARCHAR'
+    and json_type(json, '$.age') in ('BIGINT', 'UBIGINT')
+    and try_cast(json ->> '$.age' as bigint) > 0
+    and json_type(json, '$.address.address') = 'VARCHAR'
+    and regexp_matches(json ->> '$.address.address', 'Street$')
+    and json_type(json, '$.address.city') = 'VARCHAR'
+    and json_type(json, '$.address.postalCode') = 'VARCHAR'
+    and regexp_matches(json ->> '$.address.postalCode', '^[0-9]{5}'),
+    false
+  ) as is_valid
+from read_ndjson_objects($input_file)
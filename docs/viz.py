@@ -1,9 +1,15 @@
 import altair as alt
 import pandas as pd
 
+# evaluate transforms such as transform_bin with VegaFusion (requires the
+# vegafusion package, and vl-convert-python to save charts) so only their
+# results are embedded in the chart spec. to_dict() and to_json() then need
+# format="vega"
+alt.data_transformers.enable("vegafusion")
+
 
 def visualize_user_summary(data_file="user_summary.csv"):
-    source = pd.read_csv(data_file)
+    source = pd.read_csv(data_file, engine="pyarrow", dtype_backend="pyarrow")
     points = (
         alt.Chart(
             source,
@@ -32,7 +38,7 @@ def visualize_user_summary(data_file="user_summary.csv"):
 
 
 def visualize_category_summary(data_file="category_summary.csv"):
-    source = pd.read_csv(data_file)
+    source = pd.read_csv(data_file, engine="pyarrow", dtype_backend="pyarrow")
     total_sales = (
         alt.Chart(source)
         .encode(